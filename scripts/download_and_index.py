@@ -1,29 +1,34 @@
 import json
 
-from mybgg.downloader import Downloader
-from mybgg.indexer import Indexer
 from setup_logging import setup_logging
 
 def main(args):
-    SETTINGS = json.load(open("config.json", "rb"))
+    with open("config.json", "rb") as config_file:
+        SETTINGS = json.load(config_file)
+
+    # Imported here so that --help, argument errors and a missing config.json don't pay for loading requests
+    from mybgg.downloader import Downloader
 
     downloader = Downloader(
         project_name=SETTINGS["project"]["name"],
         cache_bgg=args.cache_bgg,
         debug=args.debug,
+        concurrency=args.concurrency,
     )
     collection = downloader.collection(
         user_name=SETTINGS["boardgamegeek"]["user_name"],
         extra_params=SETTINGS["boardgamegeek"]["extra_params"],
     )
     num_games = len(collection)
-    num_expansions = sum([len(game.expansions) for game in collection])
+    num_expansions = sum(len(game.expansions) for game in collection)
     print(f"Imported {num_games} games and {num_expansions} expansions from boardgamegeek.")
 
     if not len(collection):
         assert False, "No games imported, is the boardgamegeek part of config.json correctly set?"
 
     if not args.no_indexing:
+        from mybgg.indexer import Indexer
+
         hits_per_page = SETTINGS["algolia"].get("hits_per_page", 48)
         indexer = Indexer(
             app_id=SETTINGS["algolia"]["app_id"],
@@ -73,7 +78,15 @@ if __name__ == '__main__':
         action='store_true',
         help="Print debug information, such as requests made and responses received."
     )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help="The maximum number of requests to send to BGG at the same time."
+    )
 
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
 
     main(args)
@@ -1,31 +1,69 @@
 import logging
 import random
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from xml.etree.ElementTree import fromstring
 
-import declxml as xml
 import requests
+from requests.adapters import HTTPAdapter
 from requests_cache import CachedSession
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+WHITESPACE = re.compile(r"\s+")
+WHITESPACE_AFTER_TAG = re.compile(r">\s+")
+WHITESPACE_BEFORE_TAG = re.compile(r"\s+<")
+
+# How many times to retry a request when the connection fails, or drops while the response is being read
+CONNECTION_RETRIES = 3
+
+# Status flags on collection items that are turned into tags
+COLLECTION_STATUSES = (
+    "fortrade", "own", "preordered", "prevowned", "want", "wanttobuy", "wanttoplay", "wishlist",
+)
+
 class BGGClient:
     BASE_URL = "https://www.boardgamegeek.com/xmlapi2"
 
-    def __init__(self, cache=None, debug=False):
+    def __init__(self, cache=None, debug=False, concurrency=8):
+        self.concurrency = concurrency
+
+        # game_list calls run in parallel, and each starts its own workers, so limit requests for the whole client
+        self.request_slots = threading.BoundedSemaphore(concurrency)
+
         if not cache:
             self.requester = requests.Session()
         else:
             self.requester = cache.cache
 
+        # Keep enough pooled connections around for the parallel requests in game_list, and let urllib3
+        # retry throttling and BGG's "request accepted, try again later" responses. Connection errors are
+        # retried in _make_request instead, so they aren't retried twice over.
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=max(concurrency, 32),
+            max_retries=Retry(
+                total=10,
+                connect=0,
+                read=0,
+                backoff_factor=1,
+                status_forcelist=[202, 429, 500, 502, 503, 504],
+            ),
+        )
+        self.requester.mount("https://", adapter)
+
         if debug:
             logging.basicConfig(level=logging.DEBUG)
 
     def collection(self, user_name, **kwargs):
         params = kwargs.copy()
         params["username"] = user_name
-        data = self._make_request("/collection?version=1", params)
-        collection = self._collection_to_games(data)
+        tree = self._make_request("/collection?version=1", params)
+        collection = self._collection_to_games(tree)
         return collection
 
     def plays(self, user_name):
@@ -35,14 +73,14 @@ class BGGClient:
         }
         all_plays = []
 
-        data = self._make_request("/plays?version=1", params)
-        new_plays = self._plays_to_games(data)
+        tree = self._make_request("/plays?version=1", params)
+        new_plays = self._plays_to_games(tree)
 
         while (len(new_plays) > 0):
             all_plays = all_plays + new_plays
             params["page"] += 1
-            data = self._make_request("/plays?version=1", params)
-            new_plays = self._plays_to_games(data)
+            tree = self._make_request("/plays?version=1", params)
+            new_plays = self._plays_to_games(tree)
 
         return all_plays
 
@@ -51,264 +89,181 @@ class BGGClient:
             return []
 
         # Split game_ids into smaller chunks to avoid "414 URI too long"
-        def chunks(iterable, n):
-            for i in range(0, len(iterable), n):
-                yield iterable[i:i + n]
+        chunks = [game_ids[i:i + 20] for i in range(0, len(game_ids), 20)]
+
+        # Chunks are independent, so fetch them in parallel
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(self._fetch_thing_chunk, chunks)
 
         games = []
-        for game_ids_subset in chunks(game_ids, 20):
-            url = "/thing/?stats=1&id=" + ",".join([str(id_) for id_ in game_ids_subset])
-            data = self._make_request(url)
-            games += self._games_list_to_games(data)
+        for chunk_games in results:
+            games += chunk_games
 
         return games
 
-    def _make_request(self, url, params={}, tries=0):
+    def _fetch_thing_chunk(self, game_ids):
+        url = "/thing/?stats=1&id=" + ",".join([str(id_) for id_ in game_ids])
+        tree = self._make_request(url)
+        return self._games_list_to_games(tree)
+
+    def _make_request(self, url, params={}):
         """
         Makes a request to the specified URL with the given parameters.
 
         Args:
             url (str): The URL to make the request to.
             params (dict, optional): The parameters to include in the request. Defaults to an empty dictionary.
-            tries (int, optional): The number of times the request has been retried. Defaults to 0.
 
         Returns:
-            str: The response text.
+            Element: The parsed XML response, so callers don't have to parse it again.
 
         Raises:
             BGGException: If the request encounters errors or the BGG API closes the connection prematurely.
 
         Notes:
-            - This method uses exponential backoff and jitter for retrying failed requests.
-            - If the request encounters HTTP errors (4xx or 5xx status codes), a `BGGException` is raised.
-            - If the request encounters connection errors or chunked encoding errors, the method will retry the request up to 10 times.
-            - If the request encounters a "Too Many Requests" error, the method will retry the request up to 3 times with a 30-second delay between retries.
+            - Status retries are handled by the urllib3 `Retry` policy mounted on the session in `__init__`, which
+              uses exponential backoff for "Too Many Requests", server errors, and the 202 status BGG returns while a
+              collection request is still being processed.
+            - Connections that fail, or are closed while the response is being read, are retried here, up to
+              `CONNECTION_RETRIES` times with exponential backoff and jitter.
+            - If the retries run out, or the request encounters other HTTP errors, a `BGGException` is raised.
             - If the response contains XML errors, a `BGGException` is raised with the specific error messages.
-            - This method is recursive, meaning it calls itself if a retry is needed.
         """
 
-        def sleep_with_backoff_and_jitter(base_time, tries=1, jitter_factor=0.5):
-            """Sleep with exponential backoff and jitter."""
-            sleep_time = base_time * 2 ** tries * random.uniform(1 - jitter_factor, 1 + jitter_factor)
-            time.sleep(sleep_time)
-
-        try:
-            response = self.requester.get(BGGClient.BASE_URL + url, params=params)
-            response.raise_for_status()  # This will raise an exception for 4xx and 5xx status codes
-        except (
-            requests.exceptions.HTTPError,
-            requests.exceptions.ConnectionError,
-            requests.exceptions.ChunkedEncodingError
-        ):
-            if tries < 10:
-                sleep_with_backoff_and_jitter(1, tries)
-                return self._make_request(url, params=params, tries=tries + 1)
-            else:
-                raise BGGException("BGG API closed the connection prematurely, please try again...")
-        except requests.exceptions.TooManyRequests:
-            if tries < 3:
-                logger.debug("BGG returned \"Too Many Requests\", waiting 30 seconds before trying again...")
-                sleep_with_backoff_and_jitter(30, tries)
-                return self._make_request(url, params=params, tries=tries + 1)
-            else:
+        for tries in range(CONNECTION_RETRIES + 1):
+            if tries:
+                time.sleep(2 ** tries * random.uniform(0.5, 1.5))
+
+            try:
+                with self.request_slots:
+                    response = self.requester.get(BGGClient.BASE_URL + url, params=params)
+                response.raise_for_status()  # This will raise an exception for 4xx and 5xx status codes
+                break
+            except requests.exceptions.RetryError:
+                raise BGGException("BGG API request not processed in time, please try again later.")
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError
+            ):
+                if tries == CONNECTION_RETRIES:
+                    raise BGGException("BGG API closed the connection prematurely, please try again...")
+
+                logger.debug("Connection to BGG failed while requesting %s, trying again...", url)
+            except requests.exceptions.HTTPError:
                 raise BGGException(f"BGG returned status code {response.status_code} when requesting {response.url}")
 
-        logger.debug("REQUEST: " + response.url)
-        logger.debug("RESPONSE: \n" + prettify_if_xml(response.text))
+        # Prettifying is expensive, so skip it entirely unless it will be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("REQUEST: %s", response.url)
+            logger.debug("RESPONSE: \n%s", prettify_if_xml(response.text))
 
         tree = fromstring(response.text)
-        if tree.tag == "message" and "Your request for this collection has been accepted" in tree.text:
-            if tries < 10:
-                logger.debug("BGG returned \"Your request for this collection has been accepted\", waiting 10 seconds before trying again...")
-                sleep_with_backoff_and_jitter(10, tries)
-                return self._make_request(url, params=params, tries=tries + 1)
-            else:
-                raise BGGException("BGG API request not processed in time, please try again later.")
-
         if tree.tag == "errors":
             raise BGGException(
                 f"BGG returned errors while requesting {response.url} - " +
                 str([subnode.text for node in tree for subnode in node])
             )
 
-        return response.text
-
-    def _plays_to_games(self, data):
-        def after_players_hook(_, status):
-            return status["name"] if "name" in status else "Unknown"
-
-        plays_processor = xml.dictionary("plays", [
-            xml.array(
-                xml.dictionary('play', [
-                    xml.integer(".", attribute="id", alias="playid"),
-                    xml.dictionary('item', [
-                        xml.string(".", attribute="name", alias="gamename"),
-                        xml.integer(".", attribute="objectid", alias="gameid")
-                    ], alias='game'),
-                    xml.array(
-                        xml.dictionary('players/player', [
-                            xml.string(".", attribute="name", required=False, default="Unknown")
-                        ], required=False, alias='players', hooks=xml.Hooks(after_parse=after_players_hook))
-                    )
-
-                ], required=False, alias="plays")
-            )
-        ])
+        return tree
+
+    def _plays_to_games(self, tree):
+        plays = []
+        for play in tree.findall("play"):
+            item = play.find("item")
+            plays.append({
+                "playid": int(play.get("id")),
+                "game": {
+                    "gamename": stripped_attribute(item, "name"),
+                    "gameid": int(item.get("objectid")),
+                },
+                "players": [
+                    stripped_attribute(player, "name", "Unknown")
+                    for player in play.findall("players/player")
+                ],
+            })
 
-        plays = xml.parse_from_string(plays_processor, data)
-        plays = plays["plays"]
         return plays
 
-    def _collection_to_games(self, data):
-        def after_status_hook(_, status):
-            return [tag for tag, value in status.items() if value == "1"]
-
-        game_in_collection_processor = xml.dictionary("items", [
-            xml.array(
-                xml.dictionary('item', [
-                    xml.integer(".", attribute="objectid", alias="id"),
-                    xml.string("name"),
-                    xml.string("thumbnail", required=False, alias="image"),
-                    xml.string("version/item/thumbnail", required=False, alias="image_version"),
-                    xml.dictionary("status", [
-                        xml.string(".", attribute="fortrade"),
-                        xml.string(".", attribute="own"),
-                        xml.string(".", attribute="preordered"),
-                        xml.string(".", attribute="prevowned"),
-                        xml.string(".", attribute="want"),
-                        xml.string(".", attribute="wanttobuy"),
-                        xml.string(".", attribute="wanttoplay"),
-                        xml.string(".", attribute="wishlist"),
-                    ], alias='tags', hooks=xml.Hooks(after_parse=after_status_hook)),
-                    xml.integer("numplays"),
-                ], required=False, alias="items"),
-            )
-        ])
-        collection = xml.parse_from_string(game_in_collection_processor, data)
-        collection = collection["items"]
+    def _collection_to_games(self, tree):
+        collection = []
+        for item in tree.findall("item"):
+            status = item.find("status")
+            collection.append({
+                "id": int(item.get("objectid")),
+                "name": (item.findtext("name") or "").strip(),
+                "image": (item.findtext("thumbnail") or "").strip(),
+                "image_version": (item.findtext("version/item/thumbnail") or "").strip(),
+                "tags": [tag for tag in COLLECTION_STATUSES if stripped_attribute(status, tag) == "1"],
+                "numplays": int(item.findtext("numplays")),
+            })
+
         return collection
 
-    def _games_list_to_games(self, data):
-        def numplayers_to_result(_, results):
-            result = {result["value"].lower().replace(" ", "_"): int(result["numvotes"]) for result in results}
+    def _games_list_to_games(self, tree):
+        def numplayers_to_result(results):
+            result = {
+                stripped_attribute(result, "value").lower().replace(" ", "_"): int(result.get("numvotes"))
+                for result in results.findall("result")
+            }
 
             if not result:
                 result = {'best': 0, 'recommended': 0, 'not_recommended': 0}
 
-            is_recommended = result['best'] + result['recommended'] > result['not_recommended']
-            if not is_recommended:
-                return "not_recommended"
-
-            is_best = result['best'] > 10 and result['best'] > result['recommended']
-            if is_best:
-                return "best"
+            return numplayers_recommendation(result['best'], result['recommended'], result['not_recommended'])
 
-            return "recommended"
+        def suggested_numplayers(item):
+            numplayers = [
+                (stripped_attribute(results, "numplayers"), numplayers_to_result(results))
+                for results in item.findall("poll[@name='suggested_numplayers']/results")
+            ]
 
-        def suggested_numplayers(_, numplayers):
             # Remove not_recommended player counts
-            numplayers = [players for players in numplayers if players["result"] != "not_recommended"]
+            numplayers = [(num, result) for num, result in numplayers if result != "not_recommended"]
 
             # If there's only one player count, that's the best one
             if len(numplayers) == 1:
-                numplayers[0]["result"] = "best"
+                numplayers[0] = (numplayers[0][0], "best")
 
-            # Just return the numbers
-            return [
-                (players["numplayers"], players["result"])
-                for players in numplayers
-            ]
+            return numplayers
+
+        def value_of(item, path):
+            element = item.find(path)
+            if element is None:
+                return ""
+
+            return stripped_attribute(element, "value")
+
+        def values_of(item, path):
+            return [stripped_attribute(element, "value") for element in item.findall(path)]
+
+        games = []
+        for item in tree.findall("item"):
+            game = {
+                "id": int(item.get("id")),
+                "type": stripped_attribute(item, "type"),
+                "name": value_of(item, "name[@type='primary']"),
+                "description": (item.findtext("description") or "").strip(),
+                "categories": values_of(item, "link[@type='boardgamecategory']"),
+                "mechanics": values_of(item, "link[@type='boardgamemechanic']"),
+                "expansions": [
+                    {
+                        "id": int(link.get("id")),
+                        "inbound": link.get("inbound") == "true",
+                    }
+                    for link in item.findall("link[@type='boardgameexpansion']")
+                ],
+                "suggested_numplayers": suggested_numplayers(item),
+                "weight": value_of(item, "statistics/ratings/averageweight"),
+                "rank": value_of(item, "statistics/ratings/ranks/rank[@friendlyname='Board Game Rank']"),
+                "usersrated": value_of(item, "statistics/ratings/usersrated"),
+                "numowned": value_of(item, "statistics/ratings/owned"),
+                "rating": value_of(item, "statistics/ratings/bayesaverage"),
+                "playing_time": value_of(item, "playingtime"),
+                "min_age": value_of(item, "minage"),
+            }
+            logger.debug("Successfully parsed: %s (id: %s).", game["name"], game["id"])
+            games.append(game)
 
-        def log_item(_, item):
-            logger.debug("Successfully parsed: {} (id: {}).".format(item["name"], item["id"]))
-            return item
-
-        game_processor = xml.dictionary("items", [
-            xml.array(
-                xml.dictionary(
-                    "item",
-                    [
-                        xml.integer(".", attribute="id"),
-                        xml.string(".", attribute="type"),
-                        xml.string("name[@type='primary']", attribute="value", alias="name"),
-                        xml.string("description"),
-                        xml.array(
-                            xml.string(
-                                "link[@type='boardgamecategory']",
-                                attribute="value",
-                                required=False
-                            ),
-                            alias="categories",
-                        ),
-                        xml.array(
-                            xml.string(
-                                "link[@type='boardgamemechanic']",
-                                attribute="value",
-                                required=False
-                            ),
-                            alias="mechanics",
-                        ),
-                        xml.array(
-                            xml.dictionary(
-                                "link[@type='boardgameexpansion']", [
-                                    xml.integer(".", attribute="id"),
-                                    xml.boolean(".", attribute="inbound", required=False),
-                                ],
-                                required=False
-                            ),
-                            alias="expansions",
-                        ),
-                        xml.array(
-                            xml.dictionary("poll[@name='suggested_numplayers']/results", [
-                                xml.string(".", attribute="numplayers"),
-                                xml.array(
-                                    xml.dictionary("result", [
-                                        xml.string(".", attribute="value"),
-                                        xml.integer(".", attribute="numvotes"),
-                                    ], required=False),
-                                    hooks=xml.Hooks(after_parse=numplayers_to_result)
-                                )
-                            ]),
-                            alias="suggested_numplayers",
-                            hooks=xml.Hooks(after_parse=suggested_numplayers),
-                        ),
-                        xml.string(
-                            "statistics/ratings/averageweight",
-                            attribute="value",
-                            alias="weight"
-                        ),
-                        xml.string(
-                            "statistics/ratings/ranks/rank[@friendlyname='Board Game Rank']",
-                            attribute="value",
-                            required=False,
-                            alias="rank"
-                        ),
-                        xml.string(
-                            "statistics/ratings/usersrated",
-                            attribute="value",
-                            alias="usersrated"
-                        ),
-                        xml.string(
-                            "statistics/ratings/owned",
-                            attribute="value",
-                            alias="numowned"
-                        ),
-                        xml.string(
-                            "statistics/ratings/bayesaverage",
-                            attribute="value",
-                            alias="rating"
-                        ),
-                        xml.string("playingtime", attribute="value", alias="playing_time"),
-                        xml.string("minage", attribute="value", alias="min_age"),
-                    ],
-                    required=False,
-                    alias="items",
-                    hooks=xml.Hooks(after_parse=log_item),
-                )
-            )
-        ])
-        games = xml.parse_from_string(game_processor, data)
-        games = games["items"]
         return games
 
 class CacheBackendSqlite:
@@ -325,10 +280,27 @@ class CacheBackendSqlite:
 class BGGException(Exception):
     pass
 
+@lru_cache(maxsize=4096)
+def numplayers_recommendation(best, recommended, not_recommended):
+    # The same vote counts show up over and over (mostly zeros), so results are cached
+    is_recommended = best + recommended > not_recommended
+    if not is_recommended:
+        return "not_recommended"
+
+    is_best = best > 10 and best > recommended
+    if is_best:
+        return "best"
+
+    return "recommended"
+
+def stripped_attribute(element, name, default=""):
+    # Whitespace around attribute values is never meaningful in BGG's responses
+    return element.get(name, default).strip()
+
 def prettify_if_xml(xml_string):
     import xml.dom.minidom
-    import re
-    xml_string = re.sub(r"\s+<", "<", re.sub(r">\s+", ">", re.sub(r"\s+", " ", xml_string)))
+    xml_string = WHITESPACE.sub(" ", xml_string)
+    xml_string = WHITESPACE_BEFORE_TAG.sub("<", WHITESPACE_AFTER_TAG.sub(">", xml_string))
     if not xml_string.startswith("<?xml"):
         return xml_string
 
@@ -1,75 +1,156 @@
+import shelve
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from mybgg.bgg_client import BGGClient
 from mybgg.bgg_client import CacheBackendSqlite
 from mybgg.models import BoardGame
 
 
 class Downloader():
-    def __init__(self, project_name, cache_bgg, debug=False):
+    CACHE_TTL = 60 * 60 * 24
+
+    def __init__(self, project_name, cache_bgg, debug=False, concurrency=8):
+        self.concurrency = concurrency
+
         if cache_bgg:
             self.client = BGGClient(
                 cache=CacheBackendSqlite(
                     path=f"{project_name}-cache.sqlite",
-                    ttl=60 * 60 * 24,
+                    ttl=Downloader.CACHE_TTL,
                 ),
                 debug=debug,
+                concurrency=concurrency,
             )
+            self.parsed_cache_path = f"{project_name}-parsed-cache"
         else:
             self.client = BGGClient(
                 debug=debug,
+                concurrency=concurrency,
             )
+            self.parsed_cache_path = None
+
+        # game_list runs on several threads at once, and shelve doesn't support concurrent access
+        self.parsed_cache_lock = threading.Lock()
 
     def collection(self, user_name, extra_params):
-        collection_data = []
-        plays_data = []
+        if not isinstance(extra_params, list):
+            extra_params = [extra_params]
 
-        if isinstance(extra_params, list):
-            for params in extra_params:
-                collection_data += self.client.collection(
+        # Plays and each of the collection requests are independent, so fetch them all at once
+        with ThreadPoolExecutor(max_workers=min(len(extra_params), self.concurrency) + 1) as executor:
+            plays_future = executor.submit(
+                self.client.plays,
+                user_name=user_name,
+            )
+            collection_futures = [
+                executor.submit(
+                    self.client.collection,
                     user_name=user_name,
                     **params,
                 )
-        else:
-            collection_data = self.client.collection(
-                user_name=user_name,
-                **extra_params,
-            )
+                for params in extra_params
+            ]
+
+            # Start fetching game details for each collection as soon as it arrives, whichever finishes first,
+            # while the rest are still downloading. Games can be in several collections, only fetch them once.
+            index_by_future = {future: index for index, future in enumerate(collection_futures)}
+            collection_parts = [None] * len(collection_futures)
+            game_list_futures = []
+            requested_ids = set()
+            for collection_future in as_completed(collection_futures):
+                collection_part = collection_future.result()
+                collection_parts[index_by_future[collection_future]] = collection_part
+                game_ids = []
+                for game_in_collection in collection_part:
+                    if game_in_collection["id"] not in requested_ids:
+                        requested_ids.add(game_in_collection["id"])
+                        game_ids.append(game_in_collection["id"])
 
-        plays_data = self.client.plays(
-            user_name=user_name,
-        )
+                game_list_futures.append(executor.submit(self.game_list, game_ids))
 
-        game_list_data = self.client.game_list([game_in_collection["id"] for game_in_collection in collection_data])
-        game_id_to_tags = {game["id"]: game["tags"] for game in collection_data}
-        game_id_to_image = {game["id"]: game["image_version"] or game["image"] for game in collection_data}
-        game_id_to_numplays = {game["id"]: game["numplays"] for game in collection_data}
+            game_data_by_id = {}
+            for game_list_future in game_list_futures:
+                for game_data in game_list_future.result():
+                    game_data_by_id[game_data["id"]] = game_data
+
+            plays_data = plays_future.result()
+
+        # Put everything back in the configured order, so the result doesn't depend on which request finished first
+        collection_data = [game for collection_part in collection_parts for game in collection_part]
+        game_list_data = [
+            game_data_by_id[game_id]
+            for game_id in dict.fromkeys(game["id"] for game in collection_data)
+            if game_id in game_data_by_id
+        ]
+
+        game_id_to_tags = {}
+        game_id_to_image = {}
+        game_id_to_numplays = {}
+        game_id_to_players = {}
+        for game in collection_data:
+            game_id_to_tags[game["id"]] = game["tags"]
+            game_id_to_image[game["id"]] = game["image_version"] or game["image"]
+            game_id_to_numplays[game["id"]] = game["numplays"]
+            game_id_to_players[game["id"]] = []
 
-        game_id_to_players = {game["id"]: [] for game in collection_data}
         for play in plays_data:
             if play["game"]["gameid"] in game_id_to_players:
                 game_id_to_players[play["game"]["gameid"]].extend(play["players"])
                 game_id_to_players[play["game"]["gameid"]] = list(set(game_id_to_players[play["game"]["gameid"]]))
 
-        games_data = list(filter(lambda x: x["type"] == "boardgame", game_list_data))
-        expansions_data = list(filter(lambda x: x["type"] == "boardgameexpansion", game_list_data))
+        games_data = []
+        expansions_data = []
+        for game_data in game_list_data:
+            if game_data["type"] == "boardgame":
+                games_data.append(game_data)
+            elif game_data["type"] == "boardgameexpansion":
+                expansions_data.append(game_data)
 
+        # Expansions that belong to several games in the collection are only built once, and then shared
+        expansion_by_id = {}
         game_id_to_expansion = {game["id"]: [] for game in games_data}
         for expansion_data in expansions_data:
             for expansion in expansion_data["expansions"]:
                 if expansion["inbound"] and expansion["id"] in game_id_to_expansion:
-                    game_id_to_expansion[expansion["id"]].append(expansion_data)
+                    if expansion_data["id"] not in expansion_by_id:
+                        expansion_by_id[expansion_data["id"]] = BoardGame.from_game_data(expansion_data)
+
+                    game_id_to_expansion[expansion["id"]].append(expansion_by_id[expansion_data["id"]])
 
         games = [
-            BoardGame(
+            BoardGame.from_game_data(
                 game_data,
                 image=game_id_to_image[game_data["id"]],
                 tags=game_id_to_tags[game_data["id"]],
                 numplays=game_id_to_numplays[game_data["id"]],
                 previous_players=game_id_to_players[game_data["id"]],
-                expansions=[
-                    BoardGame(expansion_data)
-                    for expansion_data in game_id_to_expansion[game_data["id"]]
-                ]
+                expansions=game_id_to_expansion[game_data["id"]],
             )
             for game_data in games_data
         ]
         return games
+
+    def game_list(self, game_ids):
+        if not self.parsed_cache_path:
+            return self.client.game_list(game_ids)
+
+        # Keep parsed games around so repeated runs only fetch and parse games that are new or expired
+        now = time.time()
+        games_by_id = {}
+        with self.parsed_cache_lock, shelve.open(self.parsed_cache_path) as cache:
+            for game_id in game_ids:
+                cached = cache.get(str(game_id))
+                if cached and now - cached["time"] < Downloader.CACHE_TTL:
+                    games_by_id[game_id] = cached["game"]
+
+        missing_ids = [game_id for game_id in game_ids if game_id not in games_by_id]
+        fetched_games = self.client.game_list(missing_ids)
+
+        with self.parsed_cache_lock, shelve.open(self.parsed_cache_path) as cache:
+            for game in fetched_games:
+                cache[str(game["id"])] = {"time": now, "game": game}
+                games_by_id[game["id"]] = game
+
+        return [games_by_id[game_id] for game_id in game_ids if game_id in games_by_id]
@@ -1,15 +1,26 @@
 import io
+import random
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import colorgram
 import requests
+from requests.adapters import HTTPAdapter
 from algoliasearch.search_client import SearchClient
 from PIL import Image, ImageFile
 
-# Allow colorgram to read truncated files
+# Allow Pillow to read truncated files
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+WHITESPACE = re.compile(r"\s+")
+
+# Second level of the hierarchical players facet, for each type of player count
+PLAYERS_FACET_LEVEL2 = {
+    "best": "{num_no_plus} > Best with {num}",
+    "recommended": "{num_no_plus} > Recommended with {num}",
+    "expansion": "{num_no_plus} > Expansion allows {num}",
+}
+
 class Indexer:
 
     def __init__(self, app_id, apikey, index_name, hits_per_page):
@@ -44,6 +55,10 @@ class Indexer:
 
         self.index = index
 
+        # Images are downloaded in parallel, so keep a connection around for each worker
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
     def _init_replicas(self, client, mainIndex):
 
         mainIndex.set_settings({
@@ -63,41 +78,13 @@ class Indexer:
         replica_index = client.init_index(mainIndex.name + '_numowned_descending')
         replica_index.set_settings({'ranking': ['desc(numowned)']})
 
-    @staticmethod
-    def todict(obj):
-        if isinstance(obj, str):
-            return obj
-
-        elif isinstance(obj, dict):
-            return dict((key, Indexer.todict(val)) for key, val in obj.items())
-
-        elif hasattr(obj, '__iter__'):
-            return [Indexer.todict(val) for val in obj]
-
-        elif hasattr(obj, '__dict__'):
-            return Indexer.todict(vars(obj))
-
-        return obj
-
     def _facet_for_num_player(self, num, type_):
         num_no_plus = num.replace("+", "")
-        facet_types = {
-            "best": {
-                "level1": num_no_plus,
-                "level2": f"{num_no_plus} > Best with {num}",
-            },
-            "recommended": {
-                "level1": num_no_plus,
-                "level2": f"{num_no_plus} > Recommended with {num}",
-            },
-            "expansion": {
-                "level1": num_no_plus,
-                "level2": f"{num_no_plus} > Expansion allows {num}",
-            },
+        return {
+            "level1": num_no_plus,
+            "level2": PLAYERS_FACET_LEVEL2[type_].format(num_no_plus=num_no_plus, num=num),
         }
 
-        return facet_types[type_]
-
     def _smart_truncate(self, content, length=700, suffix='...'):
         if len(content) <= length:
             return content
@@ -122,7 +109,7 @@ class Indexer:
         description = self._pick_long_paragraph(description)
 
         # Remove unnessesary spacing
-        description = re.sub(r"\s+", " ", description)
+        description = WHITESPACE.sub(" ", description)
 
         # Cut at 700 characters, but not in the middle of a sentence
         description = self._smart_truncate(description)
@@ -151,52 +138,52 @@ class Indexer:
 
         return expansion_name
 
-    def fetch_image(self, url, tries=0):
-        try:
-            response = requests.get(url)
-        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
-            if tries < 3:
-                time.sleep(2)
-                return self.fetch_image(url, tries=tries + 1)
+    def fetch_image(self, url, retries=3):
+        for tries in range(retries + 1):
+            if tries:
+                # Back off exponentially, with jitter so parallel downloads don't all retry at the same time
+                time.sleep(2 ** tries * random.uniform(0.5, 1.5))
 
-        if response.status_code == 200:
-            return response.content
+            try:
+                response = self.session.get(url)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                continue
+
+            if response.status_code == 200:
+                return response.content
+
+            return None
 
         return None
 
+    def fetch_color(self, url):
+        image_data = self.fetch_image(url)
+        if not image_data:
+            return None
+
+        return image_color(image_data)
+
     def add_objects(self, collection):
-        games = [Indexer.todict(game) for game in collection]
-        for i, game in enumerate(games):
-            if i != 0 and i % 25 == 0:
-                print(f"Indexed {i} of {len(games)} games...")
-
-            if game["image"]:
-                image_data = self.fetch_image(game["image"])
-                if image_data:
-                    image = Image.open(io.BytesIO(image_data)).convert('RGBA')
-
-                    try_colors = 10
-                    colors = colorgram.extract(image, try_colors)
-                    for i in range(min(try_colors, len(colors))):
-                        color_r, color_g, color_b = colors[i].rgb.r, colors[i].rgb.g, colors[i].rgb.b
-
-                        # Don't return very light or dark colors
-                        luma = (
-                            0.2126 * color_r / 255.0 +
-                            0.7152 * color_g / 255.0 +
-                            0.0722 * color_b / 255.0
-                        )
-                        if (
-                            luma > 0.2 and  # Not too dark
-                            luma < 0.8     # Not too light
-                        ):
-                            break
-
-                    else:
-                        # As a fallback, use the first color
-                        color_r, color_g, color_b = colors[0].rgb.r, colors[0].rgb.g, colors[0].rgb.b
-
-                    game["color"] = f"{color_r}, {color_g}, {color_b}"
+        games = [game.todict() for game in collection]
+
+        # Cover art rarely changes between runs, so reuse the colors already in the index for unchanged images
+        color_by_image = self._indexed_colors()
+
+        # Downloading images is mostly waiting on the network, and Pillow releases the GIL while decoding and
+        # quantizing, so fetch images and extract their colors up front, many at a time
+        image_urls = list({game["image"] for game in games if game["image"] and game["image"] not in color_by_image})
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            colors = executor.map(self.fetch_color, image_urls)
+            for i, (image_url, color) in enumerate(zip(image_urls, colors), start=1):
+                if color:
+                    color_by_image[image_url] = color
+
+                if i % 25 == 0:
+                    print(f"Fetched {i} of {len(image_urls)} cover images...")
+
+        for game in games:
+            if game["image"] in color_by_image:
+                game["color"] = color_by_image[game["image"]]
 
             game["objectID"] = f"bgg{game['id']}"
 
@@ -206,6 +193,10 @@ class Indexer:
                 for num, type_ in game["players"]
             ]
 
+            # Limit the number of expansions to 10 to keep the size down, before doing any work on them
+            game["has_more_expansions"] = len(game["expansions"]) > 10
+            expansions = game["expansions"][:10]
+
             # Algolia has a limit of 10kb per item, so remove unnessesary data from expansions
             attribute_map = {
                 "id": lambda x: x,
@@ -213,23 +204,70 @@ class Indexer:
             }
             game["expansions"] = [
                 {
-                    attribute: func(expansion[attribute])
+                    attribute: value
                     for attribute, func in attribute_map.items()
-                    if func(expansion[attribute])
+                    if (value := func(expansion[attribute]))
                 }
-                for expansion in game["expansions"]
+                for expansion in expansions
             ]
-            # Limit the number of expansions to 10 to keep the size down
-            game["has_more_expansions"] = len(game["expansions"]) > 10
-            game["expansions"] = game["expansions"][:10]
 
             # Make sure description is not too long
             game["description"] = self._prepare_description(game["description"])
 
-        self.index.save_objects(games)
+        # Upload in batches, several at a time, instead of one batch after another
+        batches = [games[i:i + 1000] for i in range(0, len(games), 1000)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(self.index.save_objects, batches))
+
+    def _indexed_colors(self):
+        return {
+            hit["image"]: hit["color"]
+            for hit in self.index.browse_objects({"attributesToRetrieve": ["image", "color"]})
+            if hit.get("image") and hit.get("color")
+        }
 
     def delete_objects_not_in(self, collection):
-        delete_filter = " AND ".join([f"id != {game.id}" for game in collection])
-        self.index.delete_by({
-            'filters': delete_filter,
-        })
+        # Only fetch the ids of what's in the index, instead of sending a filter with one clause per game
+        object_ids_to_keep = {f"bgg{game.id}" for game in collection}
+        object_ids_to_delete = [
+            hit["objectID"]
+            for hit in self.index.browse_objects({"attributesToRetrieve": ["objectID"]})
+            if hit["objectID"] not in object_ids_to_keep
+        ]
+        if object_ids_to_delete:
+            self.index.delete_objects(object_ids_to_delete)
+
+def image_color(image_data):
+    image = Image.open(io.BytesIO(image_data))
+
+    # A small version of the image has the same dominant colors, and is much faster to quantize
+    image.thumbnail((100, 100))
+
+    colors = dominant_colors(image, 10)
+    for color_r, color_g, color_b in colors:
+        # Don't return very light or dark colors
+        luma = (
+            0.2126 * color_r / 255.0 +
+            0.7152 * color_g / 255.0 +
+            0.0722 * color_b / 255.0
+        )
+        if (
+            luma > 0.2 and  # Not too dark
+            luma < 0.8     # Not too light
+        ):
+            break
+
+    else:
+        # As a fallback, use the first color
+        color_r, color_g, color_b = colors[0]
+
+    return f"{color_r}, {color_g}, {color_b}"
+
+def dominant_colors(image, count):
+    # Quantize the image down to a few colors, and return them with the most common first
+    image = image.convert("RGB").quantize(colors=count)
+    palette = image.getpalette()
+    return [
+        tuple(palette[index * 3:index * 3 + 3])
+        for _, index in sorted(image.getcolors(), reverse=True)
+    ]
@@ -1,55 +1,102 @@
-from decimal import Decimal
+from bisect import bisect_right
+from dataclasses import dataclass, fields
+from operator import attrgetter
+from typing import Optional
 import html
 
+# Upper limits (in minutes, exclusive) of each playing time label, the last label is for anything longer
+PLAYING_TIME_LIMITS = (30, 60, 120, 180, 240)
+PLAYING_TIME_LABELS = ('< 30min', '30min - 1h', '1-2h', '2-3h', '3-4h', '> 4h')
 
+WEIGHT_LABELS = ("Light", "Light", "Light Medium", "Medium", "Medium Heavy", "Heavy")
+
+@dataclass
 class BoardGame:
-    def __init__(self, game_data, image="", tags=[], numplays=0, previous_players=[], expansions=[]):
-        self.id = game_data["id"]
-        self.name = game_data["name"]
-        self.description = html.unescape(game_data["description"])
-        self.categories = game_data["categories"]
-        self.mechanics = game_data["mechanics"]
-        self.players = self.calc_num_players(game_data, expansions)
-        self.weight = self.calc_weight(game_data)
-        self.playing_time = self.calc_playing_time(game_data)
-        self.min_age = self.calc_min_age(game_data)
-        self.rank = self.calc_rank(game_data)
-        self.usersrated = self.calc_usersrated(game_data)
-        self.numowned = self.calc_numowned(game_data)
-        self.rating = self.calc_rating(game_data)
-        self.numplays = numplays
-        self.image = image
-        self.tags = tags
-        self.previous_players = previous_players
-        self.expansions = expansions
-
-    def calc_num_players(self, game_data, expansions):
+    __slots__ = (
+        "id", "name", "description", "categories", "mechanics", "players", "weight", "playing_time", "min_age",
+        "rank", "usersrated", "numowned", "rating", "numplays", "image", "tags", "previous_players", "expansions",
+    )
+
+    id: int
+    name: str
+    description: str
+    categories: list
+    mechanics: list
+    players: list
+    weight: str
+    playing_time: str
+    min_age: Optional[int]
+    rank: Optional[int]
+    usersrated: int
+    numowned: int
+    rating: Optional[float]
+    numplays: int
+    image: str
+    tags: list
+    previous_players: list
+    expansions: list
+
+    @classmethod
+    def from_game_data(cls, game_data, image="", tags=None, numplays=0, previous_players=None, expansions=None):
+        expansions = expansions or []
+        return cls(
+            id=game_data["id"],
+            name=game_data["name"],
+            description=cls.calc_description(game_data),
+            categories=game_data["categories"],
+            mechanics=game_data["mechanics"],
+            players=cls.calc_num_players(game_data, expansions),
+            weight=cls.calc_weight(game_data),
+            playing_time=cls.calc_playing_time(game_data),
+            min_age=cls.calc_min_age(game_data),
+            rank=cls.calc_rank(game_data),
+            usersrated=cls.calc_usersrated(game_data),
+            numowned=cls.calc_numowned(game_data),
+            rating=cls.calc_rating(game_data),
+            numplays=numplays,
+            image=image,
+            tags=tags or [],
+            previous_players=previous_players or [],
+            expansions=expansions,
+        )
+
+    def todict(self):
+        # Unlike dataclasses.asdict this doesn't deep copy every value, callers replace values instead of mutating them
+        game = dict(zip(BOARDGAME_FIELDS, get_boardgame_fields(self)))
+        game["expansions"] = [expansion.todict() for expansion in self.expansions]
+        return game
+
+    @staticmethod
+    def calc_description(game_data):
+        description = game_data["description"]
+
+        # Most of the work in unescaping is scanning for entities, so skip it when there can't be any
+        if "&" not in description:
+            return description
+
+        return html.unescape(description)
+
+    @staticmethod
+    def calc_num_players(game_data, expansions):
         num_players = game_data["suggested_numplayers"].copy()
 
         # Add number of players from expansions
+        existing_nums = {num for num, _ in num_players}
         for expansion in expansions:
             for expansion_num, _ in expansion.players:
-                if expansion_num not in [num for num, _ in num_players]:
+                if expansion_num not in existing_nums:
                     num_players.append((expansion_num, "expansion"))
+                    existing_nums.add(expansion_num)
 
         num_players = sorted(num_players, key=lambda x: int(x[0].replace("+", "")))
         return num_players
 
-    def calc_playing_time(self, game_data):
-        playing_time_mapping = {
-            30: '< 30min',
-            60: '30min - 1h',
-            120: '1-2h',
-            180: '2-3h',
-            240: '3-4h',
-        }
-        for playing_time_max, playing_time in playing_time_mapping.items():
-            if playing_time_max > int(game_data["playing_time"]):
-                return playing_time
-
-        return '> 4h'
-
-    def calc_min_age(self, game_data):
+    @staticmethod
+    def calc_playing_time(game_data):
+        return PLAYING_TIME_LABELS[bisect_right(PLAYING_TIME_LIMITS, int(game_data["playing_time"]))]
+
+    @staticmethod
+    def calc_min_age(game_data):
         if "min_age" not in game_data or not game_data["min_age"]:
             return None
 
@@ -59,37 +106,38 @@ class BoardGame:
 
         return min_age
 
-    def calc_rank(self, game_data):
+    @staticmethod
+    def calc_rank(game_data):
         if not game_data["rank"] or game_data["rank"] == "Not Ranked":
             return None
 
-        return Decimal(game_data["rank"])
+        return int(game_data["rank"])
 
-    def calc_usersrated(self, game_data):
+    @staticmethod
+    def calc_usersrated(game_data):
         if not game_data["usersrated"]:
             return 0
 
-        return Decimal(game_data["usersrated"])
+        return int(game_data["usersrated"])
 
-    def calc_numowned(self, game_data):
+    @staticmethod
+    def calc_numowned(game_data):
         if not game_data["numowned"]:
             return 0
 
-        return Decimal(game_data["numowned"])
+        return int(game_data["numowned"])
 
-    def calc_rating(self, game_data):
+    @staticmethod
+    def calc_rating(game_data):
         if not game_data["rating"]:
             return None
 
-        return Decimal(game_data["rating"])
-
-    def calc_weight(self, game_data):
-        weight_mapping = {
-            0: "Light",
-            1: "Light",
-            2: "Light Medium",
-            3: "Medium",
-            4: "Medium Heavy",
-            5: "Heavy",
-        }
-        return weight_mapping[round(Decimal(game_data["weight"] or 0))]
+        return float(game_data["rating"])
+
+    @staticmethod
+    def calc_weight(game_data):
+        return WEIGHT_LABELS[round(float(game_data["weight"] or 0))]
+
+
+BOARDGAME_FIELDS = tuple(boardgame_field.name for boardgame_field in fields(BoardGame))
+get_boardgame_fields = attrgetter(*BOARDGAME_FIELDS)